@@ -1,31 +1,80 @@
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, render_template, request, redirect, url_for, g, abort
 import sqlite3
+import os
 from datetime import datetime, timedelta
+from library_db import (DEFAULT_BRANCH, BRANCH_DB_DIR, BRANCHES, branch_database, requested_branch,
+                        current_branch, current_database, isbn_key, backfill_isbn_keys,
+                        migrate_transactions, log_transaction, run_write)
 
 app = Flask(__name__)
 
 # --- DATABASE CONNECTION HANDLER ---
-def get_db_connection():
-    conn = sqlite3.connect('library.db')
+def get_db_connection(branch=None):
+    conn = sqlite3.connect(branch_database(branch or current_branch()))
     conn.row_factory = sqlite3.Row
     return conn
 
+# --- BRANCH SELECTION ---
+# ?branch=north (or the X-Library-Branch header) routes the request to that branch's shard
+@app.before_request
+def select_branch():
+    branch = requested_branch() or DEFAULT_BRANCH
+    if branch not in BRANCHES:
+        abort(404)
+    g.branch = branch
+
+@app.url_defaults
+def keep_branch(endpoint, values):
+    # Links and redirects stay on the branch the request came in on
+    if endpoint != 'static' and g.get('branch', DEFAULT_BRANCH) != DEFAULT_BRANCH:
+        values.setdefault('branch', g.branch)
+
+@app.context_processor
+def branch_context():
+    return {'default_branch': DEFAULT_BRANCH}
+
 # --- DATABASE SETUP ---
-def init_db():
-    with get_db_connection() as conn:
+def init_db(branch=DEFAULT_BRANCH):
+    if branch != DEFAULT_BRANCH:
+        os.makedirs(BRANCH_DB_DIR, exist_ok=True)
+    with get_db_connection(branch) as conn:
         conn.execute('''
             CREATE TABLE IF NOT EXISTS books (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 title TEXT NOT NULL,
                 author TEXT NOT NULL,
                 category TEXT,
+                isbn TEXT,
+                isbn_key INTEGER,
                 status TEXT DEFAULT 'Available',
                 borrower_name TEXT DEFAULT NULL,
                 issue_date DATE DEFAULT NULL,
                 due_date DATE DEFAULT NULL
             )
         ''')
-    seed_data()
+        # Older databases predate the ISBN columns
+        columns = [row['name'] for row in conn.execute('PRAGMA table_info(books)')]
+        if 'isbn' not in columns:
+            conn.execute('ALTER TABLE books ADD COLUMN isbn TEXT')
+        if 'isbn_key' not in columns:
+            conn.execute('ALTER TABLE books ADD COLUMN isbn_key INTEGER')
+        backfill_isbn_keys(conn)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_books_isbn_key ON books (isbn_key)')
+        # Shared event log (see app_enhanced.py for archival and history queries)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                book_id INTEGER,
+                user_id INTEGER,
+                borrower TEXT,
+                action TEXT,
+                transaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        migrate_transactions(conn)
+    # Demo books only go into the main library; new branches start empty
+    if branch == DEFAULT_BRANCH:
+        seed_data()
 
 # --- 150+ BOOKS SEED DATA ---
 def seed_data():
@@ -215,10 +264,26 @@ def inventory():
 @app.route('/add_book', methods=('GET', 'POST'))
 def add_book():
     if request.method == 'POST':
-        with get_db_connection() as conn:
-            conn.execute('INSERT INTO books (title, author, category) VALUES (?, ?, ?)', 
-                         (request.form['title'], request.form['author'], request.form['category']))
-            conn.commit()
+        isbn = request.form.get('isbn', '').strip() or None
+        key = isbn_key(isbn)
+        if isbn and key is None:
+            return render_template('add_book.html', error='That ISBN is not a valid ISBN-10 or ISBN-13.')
+        values = (request.form['title'], request.form['author'], request.form['category'], isbn, key)
+        
+        def insert_book(conn):
+            # Compare canonical keys so the ISBN-10 and ISBN-13 spellings count as one book
+            if key and conn.execute('SELECT 1 FROM books WHERE isbn_key = ?', (key,)).fetchone():
+                return False
+            cursor = conn.execute('INSERT INTO books (title, author, category, isbn, isbn_key) VALUES (?, ?, ?, ?, ?)', values)
+            log_transaction(conn, 'add', book_id=cursor.lastrowid)
+            return True
+        
+        try:
+            added = run_write(current_database(), insert_book)
+        except sqlite3.IntegrityError:
+            added = False
+        if not added:
+            return render_template('add_book.html', error='A book with that ISBN is already in the catalog.')
         return redirect(url_for('inventory'))
     return render_template('add_book.html')
 
@@ -226,18 +291,41 @@ def add_book():
 def edit_book(book_id):
     with get_db_connection() as conn:
         book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-        if request.method == 'POST':
-            conn.execute('UPDATE books SET title = ?, author = ?, category = ? WHERE id = ?', 
-                         (request.form['title'], request.form['author'], request.form['category'], book_id))
-            conn.commit()
-            return redirect(url_for('inventory'))
+    if book is None:
+        abort(404)
+    if request.method == 'POST':
+        isbn = request.form.get('isbn', '').strip() or None
+        key = isbn_key(isbn)
+        # Errors re-show what was typed, not the stored row, so other edits survive
+        submitted = dict(book, title=request.form['title'], author=request.form['author'],
+                         category=request.form['category'], isbn=isbn)
+        if isbn and key is None:
+            return render_template('edit_book.html', book=submitted, error='That ISBN is not a valid ISBN-10 or ISBN-13.')
+        values = (request.form['title'], request.form['author'], request.form['category'], isbn, key, book_id)
+        
+        def update_book(conn):
+            if key and conn.execute('SELECT 1 FROM books WHERE isbn_key = ? AND id != ?', (key, book_id)).fetchone():
+                return False
+            conn.execute('UPDATE books SET title = ?, author = ?, category = ?, isbn = ?, isbn_key = ? WHERE id = ?', values)
+            log_transaction(conn, 'edit', book_id=book_id)
+            return True
+        
+        try:
+            updated = run_write(current_database(), update_book)
+        except sqlite3.IntegrityError:
+            updated = False
+        if not updated:
+            return render_template('edit_book.html', book=submitted, error='Another book already has that ISBN.')
+        return redirect(url_for('inventory'))
     return render_template('edit_book.html', book=book)
 
 @app.route('/delete/<int:book_id>')
 def delete_book(book_id):
-    with get_db_connection() as conn:
-        conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
-        conn.commit()
+    def remove_book(conn):
+        if conn.execute('DELETE FROM books WHERE id = ?', (book_id,)).rowcount:
+            log_transaction(conn, 'delete', book_id=book_id)
+    
+    run_write(current_database(), remove_book)
     return redirect(url_for('inventory'))
 
 @app.route('/issue/<int:book_id>', methods=('GET', 'POST'))
@@ -247,10 +335,14 @@ def issue_book(book_id):
         days = int(request.form['days'])
         issue_date = datetime.now()
         due_date = issue_date + timedelta(days=days)
-        with get_db_connection() as conn:
-            conn.execute('UPDATE books SET status="Issued", borrower_name=?, issue_date=?, due_date=? WHERE id=?',
-                         (borrower, issue_date.strftime('%Y-%m-%d'), due_date.strftime('%Y-%m-%d'), book_id))
-            conn.commit()
+        
+        def mark_issued(conn):
+            cursor = conn.execute('UPDATE books SET status="Issued", borrower_name=?, issue_date=?, due_date=? WHERE id=?',
+                                  (borrower, issue_date.strftime('%Y-%m-%d'), due_date.strftime('%Y-%m-%d'), book_id))
+            if cursor.rowcount:
+                log_transaction(conn, 'issue', book_id=book_id, borrower=borrower)
+        
+        run_write(current_database(), mark_issued)
         return redirect(url_for('inventory'))
     return render_template('issue_modal.html', book_id=book_id)
 
@@ -277,13 +369,20 @@ def issued_books():
 
 @app.route('/return/<int:book_id>')
 def return_book(book_id):
-    with get_db_connection() as conn:
+    def mark_returned(conn):
+        # Only an issued book can be returned; anything else would log a phantom event
+        book = conn.execute('SELECT borrower_name FROM books WHERE id=? AND status="Issued"', (book_id,)).fetchone()
+        if book is None:
+            return
         conn.execute('UPDATE books SET status="Available", borrower_name=NULL, issue_date=NULL, due_date=NULL WHERE id=?', (book_id,))
-        conn.commit()
+        log_transaction(conn, 'return', book_id=book_id, borrower=book['borrower_name'])
+    
+    run_write(current_database(), mark_returned)
     return redirect(url_for('issued_books'))
 
-# Initialize DB
-init_db()
+# Initialize DB (one shard per branch)
+for branch in BRANCHES:
+    init_db(branch)
 
 if __name__ == '__main__':
     app.run(debug=False)
\ No newline at end of file
@@ -1,17 +1,45 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, g, abort
 import sqlite3
 from datetime import datetime, timedelta
 import os
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 import json
+import gzip
+import heapq
+import re
+import string
+import threading
+from array import array
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import click
+from library_db import (DEFAULT_BRANCH, BRANCH_DB_DIR, BRANCHES, branch_database, requested_branch,
+                        current_branch, current_database, isbn_key, backfill_isbn_keys,
+                        migrate_transactions, log_transaction, run_write)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
 
-def get_db_connection():
+# Serve index()/inventory()/api_search() from an in-memory copy of the catalog
+CATALOG_SNAPSHOT = os.environ.get('CATALOG_SNAPSHOT', 'False').lower() == 'true'
+
+# Neighbours kept per book in book_recommendations
+RECOMMENDATIONS_TOP_K = 10
+
+# Exact ISBN/barcode lookups remembered per branch between data changes
+ISBN_CACHE_SIZE = 4096
+
+# Closed months of the transaction log are moved here by `flask archive-transactions`
+ARCHIVE_DIR = os.environ.get('TRANSACTION_ARCHIVE_DIR', 'archive')
+
+def branch_archive_dir(branch):
+    return ARCHIVE_DIR if branch == DEFAULT_BRANCH else os.path.join(ARCHIVE_DIR, branch)
+
+def get_db_connection(branch=None):
     try:
-        conn = sqlite3.connect('library.db')
+        conn = sqlite3.connect(branch_database(branch or current_branch()))
         conn.row_factory = sqlite3.Row
         return conn
     except sqlite3.Error as e:
@@ -37,10 +65,32 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Branch selection: ?branch=, then the X-Library-Branch header, then the session
+@app.before_request
+def select_branch():
+    if session.get('branch', DEFAULT_BRANCH) not in BRANCHES:
+        # Branch was dropped from LIBRARY_BRANCHES; so was any login made there
+        session.clear()
+    branch = requested_branch() or session.get('branch') or DEFAULT_BRANCH
+    if branch not in BRANCHES:
+        abort(404)
+    if 'user_id' in session and branch != session.get('branch', DEFAULT_BRANCH):
+        # Each shard has its own users table, so a login only holds on the branch it was made on
+        session.clear()
+        session['branch'] = branch
+        flash('You have been signed out because you switched branches.', 'info')
+    g.branch = branch
+
+@app.context_processor
+def branch_context():
+    return {'default_branch': DEFAULT_BRANCH}
+
 # Enhanced database setup
-def init_db():
+def init_db(branch=DEFAULT_BRANCH):
     try:
-        conn = get_db_connection()
+        if branch != DEFAULT_BRANCH:
+            os.makedirs(BRANCH_DB_DIR, exist_ok=True)
+        conn = get_db_connection(branch)
         
         # Enhanced books table
         conn.execute('''
@@ -50,6 +100,7 @@ def init_db():
                 author TEXT NOT NULL,
                 category TEXT,
                 isbn TEXT UNIQUE,
+                isbn_key INTEGER,
                 language TEXT DEFAULT 'English',
                 publication_year INTEGER,
                 rating REAL DEFAULT 0.0,
@@ -63,6 +114,41 @@ def init_db():
             )
         ''')
         
+        # Canonical integer ISBN (see isbn_key); also migrates databases created by app.py
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(books)')}
+        if 'isbn' not in columns:
+            conn.execute('ALTER TABLE books ADD COLUMN isbn TEXT')
+        if 'isbn_key' not in columns:
+            conn.execute('ALTER TABLE books ADD COLUMN isbn_key INTEGER')
+        backfill_isbn_keys(conn)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_books_isbn_key ON books (isbn_key)')
+        
+        # Bumped on every change to books, so the catalog snapshot can ignore other tables' commits
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS catalog_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)')
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS books_{event.lower()}_version AFTER {event} ON books
+                BEGIN
+                    UPDATE catalog_version SET version = version + 1;
+                END
+            ''')
+        
+        # Physical copies, addressed by the barcode label stuck on each one
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS book_copies (
+                barcode TEXT PRIMARY KEY,
+                book_id INTEGER NOT NULL,
+                FOREIGN KEY (book_id) REFERENCES books (id)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_book_copies_book ON book_copies (book_id)')
+        
         # Users table
         conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -111,23 +197,59 @@ def init_db():
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 book_id INTEGER,
                 user_id INTEGER,
+                borrower TEXT,
                 action TEXT,
                 transaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (book_id) REFERENCES books (id),
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
         ''')
+        migrate_transactions(conn)
+        
+        # Co-borrowing recommendations, maintained by `flask update-recommendations`
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS borrower_books (
+                borrower_key TEXT,
+                book_id INTEGER,
+                PRIMARY KEY (borrower_key, book_id)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS co_borrow_counts (
+                book_id INTEGER,
+                other_book_id INTEGER,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (book_id, other_book_id)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS book_recommendations (
+                book_id INTEGER,
+                rank INTEGER,
+                recommended_book_id INTEGER NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (book_id, rank)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS recommendation_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        ''')
         
         conn.commit()
         conn.close()
-        seed_data()
+        # Demo books and the default admin only go into the main library
+        if branch == DEFAULT_BRANCH:
+            seed_data()
     except Exception as e:
         print(f"Database initialization error: {e}")
         raise
 
 def seed_data():
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(DEFAULT_BRANCH)
         if conn.execute('SELECT count(*) FROM books').fetchone()[0] == 0:
             # International collection with enhanced data
             books = [
@@ -141,7 +263,7 @@ def seed_data():
                 ('Python Crash Course', 'Eric Matthes', 'Technology', '9781593279288', 'English', 2019, 4.6),
                 ('Clean Code', 'Robert Martin', 'Technology', '9780132350884', 'English', 2008, 4.4),
                 ('JavaScript: The Good Parts', 'Douglas Crockford', 'Technology', '9780596517748', 'English', 2008, 4.2),
-                ('Design Patterns', 'Gang of Four', 'Technology', '9780201633612', 'English', 1994, 4.3),
+                ('Design Patterns', 'Gang of Four', 'Technology', '9780201633610', 'English', 1994, 4.3),
                 
                 # International Literature
                 ('Cien años de soledad', 'Gabriel García Márquez', 'Fiction', '9788437604947', 'Spanish', 1967, 4.5),
@@ -174,7 +296,8 @@ def seed_data():
                 ('Atomic Habits', 'James Clear', 'Self-Help', '9780735211292', 'English', 2018, 4.5),
                 ('Educated', 'Tara Westover', 'Biography', '9780399590504', 'English', 2018, 4.4)
             ]
-            conn.executemany('INSERT INTO books (title, author, category, isbn, language, publication_year, rating) VALUES (?, ?, ?, ?, ?, ?, ?)', books)
+            conn.executemany('INSERT INTO books (title, author, category, isbn, language, publication_year, rating, isbn_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             [book + (isbn_key(book[3]),) for book in books])
             conn.commit()
             print("LibraCore Database seeded with international collection.")
             
@@ -192,6 +315,549 @@ def seed_data():
         print(f"Seeding error: {e}")
         raise
 
+# --- TRANSACTION LOG ---
+
+TRANSACTION_COLUMNS = 'id, book_id, user_id, borrower, action, transaction_date'
+
+# Columns transaction_history() can filter on; each has a (column, transaction_date) index
+HISTORY_COLUMNS = ('book_id', 'user_id', 'borrower')
+
+def shift_month(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return day.replace(year=index // 12, month=index % 12 + 1, day=1)
+
+def month_bounds(month):
+    start = datetime.strptime(month, '%Y-%m').date()
+    return start.isoformat(), shift_month(start, 1).isoformat()
+
+def read_jsonl_segment(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Move one closed month out of the live log; only sqlite segments are read back by history queries
+def archive_month(conn, month, fmt='sqlite', archive_dir=ARCHIVE_DIR):
+    start, end = month_bounds(month)
+    where = 'transaction_date >= ? AND transaction_date < ?'
+    os.makedirs(archive_dir, exist_ok=True)
+
+    if fmt == 'sqlite':
+        path = os.path.join(archive_dir, f'transactions-{month}.db')
+        conn.commit()
+        conn.execute('ATTACH DATABASE ? AS archive', (path,))
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS archive.transactions (
+                    id INTEGER PRIMARY KEY,
+                    book_id INTEGER,
+                    user_id INTEGER,
+                    borrower TEXT,
+                    action TEXT,
+                    transaction_date TIMESTAMP
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_transactions_book_date ON transactions (book_id, transaction_date)')
+            conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_transactions_user_date ON transactions (user_id, transaction_date)')
+            conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_transactions_borrower_date ON transactions (borrower, transaction_date)')
+            moved = conn.execute(f'''
+                INSERT OR IGNORE INTO archive.transactions ({TRANSACTION_COLUMNS})
+                SELECT {TRANSACTION_COLUMNS} FROM main.transactions WHERE {where}
+            ''', (start, end)).rowcount
+            conn.execute(f'DELETE FROM main.transactions WHERE {where}', (start, end))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute('DETACH DATABASE archive')
+        return moved
+
+    path = os.path.join(archive_dir, f'transactions-{month}.jsonl.gz')
+    events = {row['id']: dict(row) for row in conn.execute(
+        f'SELECT {TRANSACTION_COLUMNS} FROM transactions WHERE {where}', (start, end))}
+    if not events:
+        return 0
+
+    # Re-running a month merges into the existing segment instead of duplicating it
+    merged = {event['id']: event for event in read_jsonl_segment(path)} if os.path.exists(path) else {}
+    merged.update(events)
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        for event_id in sorted(merged):
+            f.write(json.dumps(merged[event_id], separators=(',', ':')) + '\n')
+    os.replace(tmp_path, path)
+
+    conn.execute(f'DELETE FROM transactions WHERE {where}', (start, end))
+    conn.commit()
+    return len(events)
+
+# Newest-first events for one book, user or borrower; with include_archived, .db segments too
+def transaction_history(conn, column, value, limit=50, include_archived=False, archive_dir=ARCHIVE_DIR):
+    if column not in HISTORY_COLUMNS:
+        raise ValueError(f'Unsupported history column: {column}')
+
+    query = f'''
+        SELECT {TRANSACTION_COLUMNS}
+        FROM transactions
+        WHERE {column} = ?
+        ORDER BY transaction_date DESC, id DESC
+        LIMIT ?
+    '''
+    events = [dict(row) for row in conn.execute(query, (value, limit))]
+
+    if include_archived and os.path.isdir(archive_dir):
+        # Segment names sort chronologically; walk newest first and stop once filled
+        for name in sorted(os.listdir(archive_dir), reverse=True):
+            remaining = limit - len(events)
+            if remaining <= 0:
+                break
+            path = os.path.join(archive_dir, name)
+            if name.endswith('.db'):
+                archive = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+                archive.row_factory = sqlite3.Row
+                try:
+                    events.extend(dict(row) for row in archive.execute(query, (value, remaining)))
+                finally:
+                    archive.close()
+
+    return events
+
+def history_limit():
+    try:
+        return max(1, min(int(request.args.get('limit', 50)), 500))
+    except ValueError:
+        return 50
+
+# --- CATALOG SNAPSHOT ---
+
+NULL_YEAR = -2 ** 31
+
+# SQLite's LIKE folds case for ASCII letters only, so the snapshot does too
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# Regex for LIKE '%needle%' within one haystack field (% and _ never cross field separators)
+def like_pattern(needle):
+    wildcards = {'%': '[^\x00\x1f]*', '_': '[^\x00\x1f]'}
+    return re.compile(''.join(wildcards.get(ch) or re.escape(ch) for ch in needle))
+
+# Column-oriented copy of the books table; categories, languages and statuses are dictionary-encoded
+class CatalogColumns:
+    __slots__ = ('ids', 'titles', 'authors', 'isbns', 'categories', 'category_codes',
+                 'languages', 'language_codes', 'years', 'ratings', 'statuses', 'status_codes',
+                 'recent', 'haystack', 'offsets')
+
+    def __init__(self, rows):
+        self.ids = array('q')
+        self.titles = []
+        self.authors = []
+        self.isbns = []
+        self.categories = []
+        self.category_codes = array('I')
+        self.languages = []
+        self.language_codes = array('I')
+        self.years = array('i')
+        self.ratings = array('d')
+        self.statuses = []
+        self.status_codes = array('I')
+        self.offsets = array('q')
+
+        category_index = {}
+        language_index = {}
+        status_index = {}
+        created = []
+        parts = []
+        position = 0
+        for book_id, title, author, category, isbn, language, year, rating, status, created_at in rows:
+            self.ids.append(book_id)
+            self.titles.append(title)
+            self.authors.append(author)
+            self.isbns.append(isbn)
+            self.category_codes.append(category_index.setdefault(category, len(category_index)))
+            self.language_codes.append(language_index.setdefault(language, len(language_index)))
+            self.years.append(NULL_YEAR if year is None else year)
+            self.ratings.append(float('nan') if rating is None else rating)
+            self.status_codes.append(status_index.setdefault(status, len(status_index)))
+            created.append(created_at)
+
+            # Each row is "title\x1fauthor\x1fisbn\x00"; offsets map a hit back to its row
+            text = f'{title}\x1f{author}\x1f{isbn or ""}'.translate(ASCII_LOWER)
+            self.offsets.append(position)
+            parts.append(text)
+            position += len(text) + 1
+
+        self.categories = list(category_index)
+        self.languages = list(language_index)
+        self.statuses = list(status_index)
+        self.haystack = '\x00'.join(parts)
+        self.recent = heapq.nlargest(5, range(len(created)),
+                                     key=lambda i: (created[i] is not None, created[i] or ''))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def category(self, i):
+        return self.categories[self.category_codes[i]]
+
+    def language(self, i):
+        return self.languages[self.language_codes[i]]
+
+    def status(self, i):
+        return self.statuses[self.status_codes[i]]
+
+    def year(self, i):
+        year = self.years[i]
+        return None if year == NULL_YEAR else year
+
+    def rating(self, i):
+        rating = self.ratings[i]
+        return None if rating != rating else rating
+
+    def row(self, i):
+        return {
+            'id': self.ids[i],
+            'title': self.titles[i],
+            'author': self.authors[i],
+            'category': self.category(i),
+            'isbn': self.isbns[i],
+            'language': self.language(i),
+            'publication_year': self.year(i),
+            'rating': self.rating(i),
+            'status': self.status(i),
+        }
+
+    # Row indices whose title/author (and optionally isbn) are LIKE '%needle%'
+    def match(self, needle, include_isbn=True, limit=None):
+        needle = needle.translate(ASCII_LOWER)
+        if '\x00' in needle or '\x1f' in needle:
+            return []
+
+        if '%' in needle or '_' in needle:
+            pattern = like_pattern(needle)
+            def find(position):
+                found = pattern.search(self.haystack, position)
+                return (found.start(), found.end()) if found else (-1, -1)
+        else:
+            def find(position):
+                start = self.haystack.find(needle, position)
+                return start, start + len(needle)
+
+        hits = []
+        start, end = find(0)
+        while start != -1:
+            i = bisect_right(self.offsets, start) - 1
+            # The first hit in a row past title+author means only the isbn matched
+            author_end = self.offsets[i] + len(self.titles[i]) + 1 + len(self.authors[i])
+            if include_isbn or end <= author_end:
+                hits.append(i)
+                if len(hits) == limit:
+                    break
+            if i + 1 == len(self.offsets):
+                break
+            start, end = find(self.offsets[i + 1])
+        return hits
+
+    def inventory(self, search='', category='', language='', sort_by='title'):
+        indices = self.match(search) if search else range(len(self))
+
+        if category:
+            if category not in self.categories:
+                return []
+            code = self.categories.index(category)
+            indices = [i for i in indices if self.category_codes[i] == code]
+
+        if language:
+            if language not in self.languages:
+                return []
+            code = self.languages.index(language)
+            indices = [i for i in indices if self.language_codes[i] == code]
+
+        # Same ordering as SQLite: NULLs first, ties in rowid order
+        columns = {
+            'title': self.titles.__getitem__,
+            'author': self.authors.__getitem__,
+            'category': self.category,
+            'rating': self.rating,
+            'publication_year': self.year,
+        }
+        if sort_by in columns:
+            value = columns[sort_by]
+            indices = sorted(indices, key=lambda i: (value(i) is not None, value(i)))
+
+        return [self.row(i) for i in indices]
+
+    def distinct(self, column):
+        values = self.categories if column == 'category' else self.languages
+        return [{column: value} for value in sorted(values, key=lambda v: (v is not None, v))]
+
+    def stats(self):
+        status_counts = Counter(self.status_codes)
+        return {
+            'total': len(self),
+            'issued': sum(status_counts[code] for code, status in enumerate(self.statuses) if status == 'Issued'),
+            'languages': sum(1 for language in self.languages if language is not None),
+            'categories': sum(1 for category in self.categories if category is not None),
+        }
+
+    def recent_books(self):
+        return [{'title': self.titles[i], 'author': self.authors[i],
+                 'category': self.category(i), 'rating': self.rating(i)} for i in self.recent]
+
+    def popular_categories(self, limit=6):
+        counts = Counter(self.category_codes)
+        return [{'category': self.categories[code], 'count': count}
+                for code, count in counts.most_common(limit)]
+
+    def search(self, query, limit=10):
+        return [{'id': self.ids[i], 'title': self.titles[i], 'author': self.authors[i],
+                 'category': self.category(i), 'rating': self.rating(i)}
+                for i in self.match(query, include_isbn=False, limit=limit)]
+
+# Per-process catalog copy, rebuilt outside the lock whenever catalog_version moves
+class CatalogSnapshot:
+    def __init__(self, database):
+        self.database = database
+        self._conn = None
+        self._version = None
+        self._columns = None
+        self._building = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.database, check_same_thread=False)
+            version = self._conn.execute('SELECT version FROM catalog_version').fetchone()[0]
+            if self._columns is not None and (version == self._version or self._building):
+                return self._columns
+            self._building = True
+
+        # Anything committed after the poll bumps the version again and triggers the next rebuild
+        try:
+            columns = self._load()
+        except Exception:
+            with self._lock:
+                self._building = False
+            raise
+        with self._lock:
+            self._columns, self._version, self._building = columns, version, False
+        return columns
+
+    def _load(self):
+        conn = sqlite3.connect(self.database)
+        try:
+            return CatalogColumns(conn.execute('''
+                SELECT id, title, author, category, isbn, language,
+                       publication_year, rating, status, created_at
+                FROM books ORDER BY id
+            '''))
+        finally:
+            conn.close()
+
+catalog_snapshots = {}
+
+# Catalog columns for the current branch, or None when CATALOG_SNAPSHOT is off
+def catalog_snapshot():
+    if not CATALOG_SNAPSHOT:
+        return None
+    branch = current_branch()
+    snapshot = catalog_snapshots.get(branch)
+    if snapshot is None:
+        snapshot = catalog_snapshots.setdefault(branch, CatalogSnapshot(branch_database(branch)))
+    return snapshot.get()
+
+# --- RECOMMENDATIONS ---
+
+# Account if known, else the case/whitespace-folded borrower name
+def borrower_key(user_id, borrower):
+    if user_id is not None:
+        return f'u:{user_id}'
+    name = ' '.join((borrower or '').split()).casefold()
+    return f'n:{name}' if name else None
+
+# Fold new 'issue' events into co-borrowing counts and rewrite top-k for books that changed
+def update_recommendations(conn, top_k=RECOMMENDATIONS_TOP_K, rebuild=False):
+    if rebuild:
+        for table in ('borrower_books', 'co_borrow_counts', 'book_recommendations', 'recommendation_state'):
+            conn.execute(f'DELETE FROM {table}')
+
+    state = conn.execute("SELECT value FROM recommendation_state WHERE key = 'last_transaction_id'").fetchone()
+    last_id = state[0] if state else 0
+    max_id = conn.execute('SELECT MAX(id) FROM transactions').fetchone()[0] or last_id
+    events = conn.execute('''
+        SELECT user_id, borrower, book_id FROM transactions
+        WHERE id > ? AND id <= ? AND action = 'issue' AND book_id IS NOT NULL
+        ORDER BY id
+    ''', (last_id, max_id)).fetchall()
+
+    borrowed = {}
+    new_links = []
+    pairs = Counter()
+    for user_id, borrower, book_id in events:
+        key = borrower_key(user_id, borrower)
+        if key is None:
+            continue
+        if key not in borrowed:
+            borrowed[key] = {row[0] for row in conn.execute(
+                'SELECT book_id FROM borrower_books WHERE borrower_key = ?', (key,))}
+        books = borrowed[key]
+        if book_id in books:
+            continue
+        for other in books:
+            pairs[(book_id, other)] += 1
+            pairs[(other, book_id)] += 1
+        books.add(book_id)
+        new_links.append((key, book_id))
+
+    conn.executemany('INSERT OR IGNORE INTO borrower_books (borrower_key, book_id) VALUES (?, ?)', new_links)
+    conn.executemany('''
+        INSERT INTO co_borrow_counts (book_id, other_book_id, count) VALUES (?, ?, ?)
+        ON CONFLICT (book_id, other_book_id) DO UPDATE SET count = count + excluded.count
+    ''', ((book_id, other, count) for (book_id, other), count in pairs.items()))
+
+    affected = {book_id for book_id, _ in pairs}
+    for book_id in affected:
+        top = conn.execute('''
+            SELECT other_book_id, count FROM co_borrow_counts
+            WHERE book_id = ?
+            ORDER BY count DESC, other_book_id
+            LIMIT ?
+        ''', (book_id, top_k)).fetchall()
+        conn.execute('DELETE FROM book_recommendations WHERE book_id = ?', (book_id,))
+        conn.executemany('INSERT INTO book_recommendations (book_id, rank, recommended_book_id, score) VALUES (?, ?, ?, ?)',
+                         ((book_id, rank, other, count) for rank, (other, count) in enumerate(top, 1)))
+
+    conn.execute("INSERT OR REPLACE INTO recommendation_state (key, value) VALUES ('last_transaction_id', ?)", (max_id,))
+    conn.commit()
+    return len(events), len(affected)
+
+# --- ISBN / BARCODE LOOKUP ---
+
+LOOKUP_COLUMNS = '''b.id, b.title, b.author, b.category, b.isbn, b.language, b.publication_year,
+                    b.rating, b.status, b.total_copies, b.available_copies, b.due_date'''
+
+# Exact ISBN / copy-barcode lookups, cached per branch until data_version moves
+class BookLookup:
+    def __init__(self, database, size=ISBN_CACHE_SIZE):
+        self.database = database
+        self.size = size
+        self._conn = None
+        self._version = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Map each ISBN key (kind='isbn') or barcode to a book dict or None
+    def resolve(self, kind, values):
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.database, check_same_thread=False)
+                self._conn.row_factory = sqlite3.Row
+            version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            if version != self._version:
+                self._cache.clear()
+                self._version = version
+
+            found = {}
+            missing = []
+            for value in dict.fromkeys(values):
+                if (kind, value) in self._cache:
+                    self._cache.move_to_end((kind, value))
+                    found[value] = self._cache[(kind, value)]
+                else:
+                    missing.append(value)
+
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                if kind == 'isbn':
+                    query = f'SELECT b.isbn_key AS code, {LOOKUP_COLUMNS} FROM books b WHERE b.isbn_key IN ({placeholders}) ORDER BY b.id'
+                else:
+                    query = f'''
+                        SELECT c.barcode AS code, {LOOKUP_COLUMNS}
+                        FROM book_copies c JOIN books b ON b.id = c.book_id
+                        WHERE c.barcode IN ({placeholders})
+                    '''
+                rows = {}
+                for row in self._conn.execute(query, chunk):
+                    book = dict(row)
+                    rows.setdefault(book.pop('code'), book)
+                for value in chunk:
+                    found[value] = self._cache[(kind, value)] = rows.get(value)
+
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+            return found
+
+book_lookups = {}
+
+def book_lookup():
+    branch = current_branch()
+    lookup = book_lookups.get(branch)
+    if lookup is None:
+        lookup = book_lookups.setdefault(branch, BookLookup(branch_database(branch)))
+    return lookup
+
+# Valid ISBNs resolve by isbn_key, anything else as a copy barcode
+def resolve_codes(codes):
+    lookup = book_lookup()
+    keys = {code: isbn_key(code) for code in codes}
+    by_isbn = lookup.resolve('isbn', [key for key in keys.values() if key])
+    # A code that looks like an ISBN but is not in the catalog may still be a copy label
+    barcodes = [code for code, key in keys.items() if not by_isbn.get(key)]
+    by_barcode = lookup.resolve('barcode', barcodes) if barcodes else {}
+
+    results = []
+    for code in codes:
+        key = keys[code]
+        if key and by_isbn.get(key):
+            results.append({'code': code, 'type': 'isbn', 'isbn_key': key, 'book': by_isbn[key]})
+        elif by_barcode.get(code):
+            results.append({'code': code, 'type': 'barcode', 'book': by_barcode[code]})
+        else:
+            results.append({'code': code, 'type': None, 'book': None})
+    return results
+
+# --- FEDERATED SEARCH ---
+
+# sqlite3 releases the GIL while a query runs, so shards are searched in parallel
+search_pool = ThreadPoolExecutor(max_workers=min(len(BRANCHES), 16))
+
+def search_branch(branch, query, limit):
+    conn = get_db_connection(branch)
+    try:
+        rows = conn.execute('''
+            SELECT id, title, author, category, rating,
+                   CASE
+                       WHEN title = ? COLLATE NOCASE THEN 0
+                       WHEN title LIKE ? THEN 1
+                       WHEN title LIKE ? THEN 2
+                       ELSE 3
+                   END AS rank
+            FROM books
+            WHERE title LIKE ? OR author LIKE ?
+            ORDER BY rank, rating DESC, title
+            LIMIT ?
+        ''', (query, f'{query}%', f'%{query}%', f'%{query}%', f'%{query}%', limit)).fetchall()
+    finally:
+        conn.close()
+    return [dict(row, branch=branch) for row in rows]
+
+# Search every shard concurrently, merge by rank; failed shards are reported, not fatal
+def federated_search(query, limit=10):
+    futures = {search_pool.submit(search_branch, branch, query, limit): branch for branch in BRANCHES}
+    per_branch = {}
+    failed = []
+    for future in as_completed(futures):
+        try:
+            per_branch[futures[future]] = future.result()
+        except sqlite3.Error as e:
+            print(f"Search error in branch {futures[future]}: {e}")
+            failed.append(futures[future])
+
+    # Merge in branch order so ties between shards come out the same every time
+    merged = heapq.merge(*(per_branch[branch] for branch in BRANCHES if branch in per_branch),
+                         key=lambda book: (book['rank'], -(book['rating'] or 0), book['title']))
+    return [book for _, book in zip(range(limit), merged)], sorted(failed, key=BRANCHES.index)
+
 # --- ROUTES ---
 
 @app.route('/')
@@ -199,17 +865,40 @@ def index():
     try:
         conn = get_db_connection()
         
-        # Get comprehensive statistics
-        stats = conn.execute('''
-            SELECT 
-                COUNT(*) as total,
-                SUM(CASE WHEN status = 'Issued' THEN 1 ELSE 0 END) as issued,
-                COUNT(DISTINCT language) as languages,
-                COUNT(DISTINCT category) as categories
-            FROM books
-        ''').fetchone()
+        catalog = catalog_snapshot()
+        if catalog:
+            stats = catalog.stats()
+            recent_books = catalog.recent_books()
+            categories = catalog.popular_categories()
+        else:
+            # Get comprehensive statistics
+            stats = conn.execute('''
+                SELECT 
+                    COUNT(*) as total,
+                    SUM(CASE WHEN status = 'Issued' THEN 1 ELSE 0 END) as issued,
+                    COUNT(DISTINCT language) as languages,
+                    COUNT(DISTINCT category) as categories
+                FROM books
+            ''').fetchone()
+            
+            # Recent activities
+            recent_books = conn.execute('''
+                SELECT title, author, category, rating 
+                FROM books 
+                ORDER BY created_at DESC 
+                LIMIT 5
+            ''').fetchall()
+            
+            # Popular categories
+            categories = conn.execute('''
+                SELECT category, COUNT(*) as count 
+                FROM books 
+                GROUP BY category 
+                ORDER BY count DESC 
+                LIMIT 6
+            ''').fetchall()
         
-        # Calculate overdue and fines
+        # Calculate overdue and fines (depends on today's date, so always from SQL)
         today = datetime.now().date()
         overdue_books = conn.execute('''
             SELECT COUNT(*) as overdue, 
@@ -218,23 +907,6 @@ def index():
             WHERE status = 'Issued' AND due_date < date('now')
         ''').fetchone()
         
-        # Recent activities
-        recent_books = conn.execute('''
-            SELECT title, author, category, rating 
-            FROM books 
-            ORDER BY created_at DESC 
-            LIMIT 5
-        ''').fetchall()
-        
-        # Popular categories
-        categories = conn.execute('''
-            SELECT category, COUNT(*) as count 
-            FROM books 
-            GROUP BY category 
-            ORDER BY count DESC 
-            LIMIT 6
-        ''').fetchall()
-        
         conn.close()
         
         # Enhanced multilingual support
@@ -303,18 +975,34 @@ def index():
 @app.route('/inventory')
 def inventory():
     try:
-        conn = get_db_connection()
-        
         # Advanced filtering
         search = request.args.get('q', '')
         category = request.args.get('category', '')
         language = request.args.get('language', '')
         sort_by = request.args.get('sort', 'title')
         
+        # A scanned or typed ISBN becomes an exact indexed match instead of LIKE
+        scanned_isbn = isbn_key(search) if search else None
+        
+        catalog = None if scanned_isbn else catalog_snapshot()
+        if catalog:
+            return render_template('inventory.html', 
+                                 books=catalog.inventory(search, category, language, sort_by), 
+                                 categories=catalog.distinct('category'),
+                                 languages=catalog.distinct('language'),
+                                 current_search=search,
+                                 current_category=category,
+                                 current_language=language,
+                                 current_sort=sort_by)
+        
+        conn = get_db_connection()
         query = 'SELECT * FROM books WHERE 1=1'
         params = []
         
-        if search:
+        if scanned_isbn:
+            query += ' AND isbn_key = ?'
+            params.append(scanned_isbn)
+        elif search:
             query += ' AND (title LIKE ? OR author LIKE ? OR isbn LIKE ?)'
             params.extend([f'%{search}%', f'%{search}%', f'%{search}%'])
         
@@ -351,6 +1039,16 @@ def inventory():
         flash(f'Error loading inventory: {str(e)}', 'error')
         return redirect(url_for('index'))
 
+@app.route('/branch/<branch>')
+def switch_branch(branch):
+    if branch not in BRANCHES:
+        abort(404)
+    if branch != session.get('branch', DEFAULT_BRANCH):
+        session.clear()
+    session['branch'] = branch
+    flash(f'Now working in the {branch} branch.', 'info')
+    return redirect(url_for('index', branch=branch))
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -371,6 +1069,7 @@ def login():
                 session['username'] = user['username']
                 session['role'] = user['role']
                 session['full_name'] = user['full_name']
+                session['branch'] = current_branch()
                 flash(f'Welcome back, {user["full_name"]}!', 'success')
                 return redirect(url_for('index'))
             else:
@@ -399,23 +1098,25 @@ def register():
             flash('All fields except phone are required.', 'error')
             return render_template('register.html')
         
-        try:
-            conn = get_db_connection()
-            
+        password_hash = generate_password_hash(password)
+        
+        def create_user(conn):
             # Check if user exists
             existing = conn.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email)).fetchone()
             if existing:
-                flash('Username or email already exists.', 'error')
-                conn.close()
-                return render_template('register.html')
+                return False
             
-            password_hash = generate_password_hash(password)
-            conn.execute('''
+            cursor = conn.execute('''
                 INSERT INTO users (username, email, password_hash, full_name, phone) 
                 VALUES (?, ?, ?, ?, ?)
             ''', (username, email, password_hash, full_name, phone))
-            conn.commit()
-            conn.close()
+            log_transaction(conn, 'register', user_id=cursor.lastrowid)
+            return True
+        
+        try:
+            if not run_write(current_database(), create_user):
+                flash('Username or email already exists.', 'error')
+                return render_template('register.html')
             
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('login'))
@@ -474,6 +1175,10 @@ def api_search():
         return jsonify([])
     
     try:
+        catalog = catalog_snapshot()
+        if catalog:
+            return jsonify(catalog.search(query))
+        
         conn = get_db_connection()
         results = conn.execute('''
             SELECT id, title, author, category, rating 
@@ -487,8 +1192,171 @@ def api_search():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# Initialize database
-init_db()
+@app.route('/api/search/all')
+def api_federated_search():
+    query = request.args.get('q', '')
+    if len(query) < 2:
+        return jsonify({'results': [], 'failed_branches': []})
+    
+    try:
+        results, failed = federated_search(query)
+        return jsonify({'results': results, 'failed_branches': failed})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/books/by-isbn/<isbn>')
+def api_book_by_isbn(isbn):
+    key = isbn_key(isbn)
+    if key is None:
+        return jsonify({'error': 'Invalid ISBN'}), 400
+    
+    try:
+        book = book_lookup().resolve('isbn', [key])[key]
+        if book is None:
+            return jsonify({'error': 'Book not found'}), 404
+        return jsonify(dict(book, isbn_key=key))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/copies/<barcode>')
+def api_copy_by_barcode(barcode):
+    try:
+        book = book_lookup().resolve('barcode', [barcode])[barcode]
+        if book is None:
+            return jsonify({'error': 'Copy not found'}), 404
+        return jsonify(dict(book, barcode=barcode))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Resolve a whole scanned cart: {"codes": ["978...", "LIB-000123", ...]}
+@app.route('/api/books/resolve', methods=['POST'])
+def api_resolve_codes():
+    payload = request.get_json(silent=True) or {}
+    codes = payload.get('codes')
+    if not isinstance(codes, list) or not all(isinstance(code, str) for code in codes):
+        return jsonify({'error': 'Expected {"codes": [...]} with string codes'}), 400
+    if len(codes) > 1000:
+        return jsonify({'error': 'At most 1000 codes per request'}), 400
+    
+    try:
+        return jsonify(resolve_codes([code.strip() for code in codes]))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/recommendations/<int:book_id>')
+def api_recommendations(book_id):
+    try:
+        conn = get_db_connection()
+        results = conn.execute('''
+            SELECT b.id, b.title, b.author, b.category, b.rating, r.score
+            FROM book_recommendations r
+            JOIN books b ON b.id = r.recommended_book_id
+            WHERE r.book_id = ?
+            ORDER BY r.rank
+        ''', (book_id,)).fetchall()
+        conn.close()
+
+        return jsonify([dict(row) for row in results])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/books/<int:book_id>/history')
+@admin_required
+def api_book_history(book_id):
+    try:
+        conn = get_db_connection()
+        events = transaction_history(conn, 'book_id', book_id, history_limit(),
+                                     request.args.get('archived') == '1', branch_archive_dir(current_branch()))
+        conn.close()
+        return jsonify(events)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/users/<int:user_id>/history')
+@login_required
+def api_user_history(user_id):
+    if session.get('role') != 'admin' and session['user_id'] != user_id:
+        return jsonify({'error': 'Forbidden'}), 403
+
+    try:
+        conn = get_db_connection()
+        events = transaction_history(conn, 'user_id', user_id, history_limit(),
+                                     request.args.get('archived') == '1', branch_archive_dir(current_branch()))
+        conn.close()
+        return jsonify(events)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/borrowers/<path:borrower>/history')
+@admin_required
+def api_borrower_history(borrower):
+    try:
+        conn = get_db_connection()
+        events = transaction_history(conn, 'borrower', borrower, history_limit(),
+                                     request.args.get('archived') == '1', branch_archive_dir(current_branch()))
+        conn.close()
+        return jsonify(events)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# --- CLI COMMANDS ---
+
+@app.cli.command('archive-transactions')
+@click.option('--keep-months', default=12, show_default=True,
+              help='Months, including the current one, kept in the live table.')
+@click.option('--format', 'fmt', type=click.Choice(['sqlite', 'jsonl']), default='sqlite', show_default=True,
+              help='sqlite segments stay searchable via the history APIs; jsonl is export-only cold storage.')
+@click.option('--branch', type=click.Choice(BRANCHES), default=DEFAULT_BRANCH, show_default=True)
+def archive_transactions(keep_months, fmt, branch):
+    """Move closed months of the transaction log into per-month segments."""
+    # The default keeps the 12-month window that analytics() reports on
+    cutoff = shift_month(datetime.now().date(), 1 - max(keep_months, 1)).isoformat()
+    conn = get_db_connection(branch)
+    months = [row[0] for row in conn.execute('''
+        SELECT DISTINCT strftime('%Y-%m', transaction_date)
+        FROM transactions
+        WHERE transaction_date < ?
+        ORDER BY 1
+    ''', (cutoff,))]
+
+    for month in months:
+        moved = archive_month(conn, month, fmt, branch_archive_dir(branch))
+        click.echo(f'{month}: archived {moved} events')
+
+    conn.close()
+    if not months:
+        click.echo('Nothing to archive.')
+
+@app.cli.command('update-recommendations')
+@click.option('--top-k', default=RECOMMENDATIONS_TOP_K, show_default=True, help='Recommendations kept per book.')
+@click.option('--rebuild', is_flag=True, help='Discard state and recount from the live transaction log.')
+@click.option('--branch', type=click.Choice(BRANCHES), default=DEFAULT_BRANCH, show_default=True)
+def update_recommendations_command(top_k, rebuild, branch):
+    """Refresh "readers also borrowed" from new circulation events."""
+    conn = get_db_connection(branch)
+    events, books = update_recommendations(conn, top_k, rebuild)
+    conn.close()
+    click.echo(f'Processed {events} loans, updated recommendations for {books} books.')
+
+@app.cli.command('register-copies')
+@click.argument('book_id', type=int)
+@click.argument('barcodes', nargs=-1, required=True)
+@click.option('--branch', type=click.Choice(BRANCHES), default=DEFAULT_BRANCH, show_default=True)
+def register_copies(book_id, barcodes, branch):
+    """Attach barcode labels for physical copies of a book."""
+    conn = get_db_connection(branch)
+    if conn.execute('SELECT 1 FROM books WHERE id = ?', (book_id,)).fetchone() is None:
+        conn.close()
+        raise click.ClickException(f'No book with id {book_id}')
+    conn.executemany('INSERT OR REPLACE INTO book_copies (barcode, book_id) VALUES (?, ?)',
+                     [(barcode, book_id) for barcode in barcodes])
+    conn.commit()
+    conn.close()
+    click.echo(f'Registered {len(barcodes)} copies of book {book_id}.')
+
+# Initialize database (one shard per branch)
+for branch in BRANCHES:
+    init_db(branch)
 
 if __name__ == '__main__':
     debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
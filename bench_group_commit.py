@@ -0,0 +1,82 @@
+"""Compare per-request commits with GroupCommitWriter.
+
+Simulates concurrent mutation requests (one book UPDATE plus one
+transaction-log INSERT each, like issue_book/return_book) against an on-disk
+SQLite file and reports committed writes per second.
+
+    python bench_group_commit.py [--threads 16] [--writes 200]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from group_commit import GroupCommitWriter
+
+
+def setup(path):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE books (id INTEGER PRIMARY KEY, status TEXT)')
+    conn.execute('CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, book_id INTEGER, action TEXT)')
+    conn.executemany('INSERT INTO books (id, status) VALUES (?, ?)', [(i, 'Available') for i in range(1000)])
+    conn.commit()
+    conn.close()
+
+
+def mutation(book_id):
+    def fn(conn):
+        conn.execute("UPDATE books SET status = 'Issued' WHERE id = ?", (book_id,))
+        conn.execute("INSERT INTO transactions (book_id, action) VALUES (?, 'issue')", (book_id,))
+    return fn
+
+
+def direct_write(path, fn):
+    # What the routes do without group commit: own connection, own commit
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        with conn:
+            fn(conn)
+    finally:
+        conn.close()
+
+
+def run(threads, writes, submit):
+    def worker(offset):
+        for i in range(writes):
+            submit(mutation((offset * writes + i) % 1000))
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return threads * writes / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=200, help='writes per thread')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'before.db')
+        setup(path)
+        before = run(args.threads, args.writes, lambda fn: direct_write(path, fn))
+
+        path = os.path.join(tmp, 'after.db')
+        setup(path)
+        writer = GroupCommitWriter(path)
+        after = run(args.threads, args.writes, writer.submit)
+        writer.close()
+
+    print(f'{args.threads} threads x {args.writes} writes')
+    print(f'per-request commit: {before:10.0f} writes/s')
+    print(f'group commit:       {after:10.0f} writes/s  ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
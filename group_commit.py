@@ -0,0 +1,92 @@
+"""Group commit for SQLite writes: concurrent writes share one transaction and one fsync."""
+import queue
+import sqlite3
+import threading
+import time
+
+
+class _Job:
+    __slots__ = ('fn', 'result', 'error', 'done')
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitWriter:
+    """Single writer thread; each queued write runs in its own SAVEPOINT within a shared transaction."""
+
+    def __init__(self, database, max_delay=0.0, max_batch=256):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        # Autocommit mode so BEGIN/COMMIT below are the only transaction boundaries
+        self._conn = sqlite3.connect(database, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f'group-commit:{database}', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn):
+        """Run ``fn(conn)`` in the next batch and block until it is committed."""
+        if self._closed:
+            raise RuntimeError('GroupCommitWriter is closed')
+        job = _Job(fn)
+        self._queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def close(self):
+        """Flush queued writes and stop the writer thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            self._conn.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            job = self._queue.get()
+            if job is None:
+                break
+            batch = [job]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        conn = self._conn
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for job in batch:
+                conn.execute('SAVEPOINT job')
+                try:
+                    job.result = job.fn(conn)
+                    conn.execute('RELEASE job')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO job')
+                    conn.execute('RELEASE job')
+                    job.error = e
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for job in batch:
+                if job.error is None:
+                    job.result, job.error = None, e
+        finally:
+            for job in batch:
+                job.done.set()
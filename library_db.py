@@ -0,0 +1,111 @@
+"""Database helpers shared by app.py and app_enhanced.py, which write to the same SQLite files."""
+import os
+import re
+import sqlite3
+import threading
+
+from flask import g, has_request_context, request
+
+from group_commit import GroupCommitWriter
+
+DATABASE = 'library.db'
+
+# Each extra branch (LIBRARY_BRANCHES=north,south) is its own SQLite shard, so
+# branches never queue behind each other's write lock. 'main' is library.db.
+DEFAULT_BRANCH = 'main'
+BRANCH_DB_DIR = os.environ.get('BRANCH_DB_DIR', 'branches')
+BRANCHES = [DEFAULT_BRANCH] + [
+    branch.strip() for branch in os.environ.get('LIBRARY_BRANCHES', '').split(',')
+    if branch.strip() and branch.strip() != DEFAULT_BRANCH
+]
+
+# Coalesce concurrent writes into shared transactions (see group_commit.py)
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'False').lower() == 'true'
+# How long the writer lingers for more writes before committing a batch
+GROUP_COMMIT_DELAY = float(os.environ.get('GROUP_COMMIT_DELAY_MS', '0')) / 1000
+
+
+def branch_database(branch):
+    if branch not in BRANCHES:
+        raise ValueError(f'Unknown branch: {branch}')
+    if branch == DEFAULT_BRANCH:
+        return DATABASE
+    return os.path.join(BRANCH_DB_DIR, f'{branch}.db')
+
+
+def requested_branch():
+    """Branch named by ``?branch=`` or the X-Library-Branch header, if any."""
+    return request.args.get('branch') or request.headers.get('X-Library-Branch')
+
+
+def current_branch():
+    """Branch chosen for this request (``g.branch``), or the default outside requests."""
+    if has_request_context() and 'branch' in g:
+        return g.branch
+    return DEFAULT_BRANCH
+
+
+def current_database():
+    return branch_database(current_branch())
+
+
+def isbn_key(value):
+    """Canonical integer ISBN-13 for an ISBN-10 or ISBN-13 (check digit verified), or None."""
+    digits = str(value or '').replace('-', '').replace(' ', '').upper()
+    if re.fullmatch(r'\d{9}[\dX]', digits):
+        if sum((10 - i) * (10 if ch == 'X' else int(ch)) for i, ch in enumerate(digits)) % 11:
+            return None
+        digits = '978' + digits[:9]
+        digits += str(-sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(digits)) % 10)
+    elif not re.fullmatch(r'\d{13}', digits):
+        return None
+    elif sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(digits)) % 10:
+        return None
+    return int(digits)
+
+
+def backfill_isbn_keys(conn):
+    """Fill books.isbn_key for rows written before the column existed."""
+    conn.executemany('UPDATE books SET isbn_key = ? WHERE id = ?', [
+        (isbn_key(isbn), book_id)
+        for book_id, isbn in conn.execute('SELECT id, isbn FROM books WHERE isbn IS NOT NULL AND isbn_key IS NULL')
+    ])
+
+
+def migrate_transactions(conn):
+    """Bring an existing transactions table up to date and create its indexes."""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(transactions)')]
+    if 'borrower' not in columns:
+        conn.execute('ALTER TABLE transactions ADD COLUMN borrower TEXT')
+    # History lookups are always "events for X, newest first"
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_book_date ON transactions (book_id, transaction_date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions (user_id, transaction_date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_borrower_date ON transactions (borrower, transaction_date)')
+
+
+def log_transaction(conn, action, book_id=None, user_id=None, borrower=None):
+    """Append an event to the transaction log inside the caller's open transaction."""
+    conn.execute('INSERT INTO transactions (book_id, user_id, borrower, action) VALUES (?, ?, ?, ?)',
+                 (book_id, user_id, borrower, action))
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def run_write(database, fn):
+    """Run ``fn(conn)`` (which must not commit) as a durable write and return its result."""
+    if not GROUP_COMMIT:
+        conn = sqlite3.connect(database)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                return fn(conn)
+        finally:
+            conn.close()
+
+    with _writers_lock:
+        writer = _writers.get(database)
+        if writer is None:
+            writer = _writers[database] = GroupCommitWriter(database, max_delay=GROUP_COMMIT_DELAY)
+    return writer.submit(fn)
@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+
+import pytest
+
+import library_db
+from group_commit import GroupCommitWriter
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'writes.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE notes (id INTEGER PRIMARY KEY, body TEXT)')
+    conn.commit()
+    conn.close()
+    return path
+
+
+def insert(body, fail=False):
+    def fn(conn):
+        conn.execute('INSERT INTO notes (body) VALUES (?)', (body,))
+        if fail:
+            raise ValueError(body)
+        return body
+    return fn
+
+
+def bodies(path):
+    conn = sqlite3.connect(path)
+    try:
+        return sorted(row[0] for row in conn.execute('SELECT body FROM notes'))
+    finally:
+        conn.close()
+
+
+def test_failing_write_is_rolled_back_alone_within_its_batch(database):
+    writer = GroupCommitWriter(database)
+    batches = []
+    commit = writer._commit
+    writer._commit = lambda batch: (batches.append(len(batch)), commit(batch))
+
+    # Hold the writer in a first batch so the next three queue up and share one
+    started, release = threading.Event(), threading.Event()
+    def blocker(conn):
+        started.set()
+        release.wait()
+    results = {}
+    def submit(name, fn):
+        try:
+            results[name] = writer.submit(fn)
+        except Exception as e:
+            results[name] = e
+    threads = [threading.Thread(target=submit, args=('blocker', blocker))]
+    threads[0].start()
+    started.wait()
+    for name, fail in (('a', False), ('b', True), ('c', False)):
+        threads.append(threading.Thread(target=submit, args=(name, insert(name, fail))))
+        threads[-1].start()
+    while writer._queue.qsize() < 3:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+    writer.close()
+
+    assert batches == [1, 3]
+    assert results['a'] == 'a' and results['c'] == 'c'
+    assert isinstance(results['b'], ValueError) and str(results['b']) == 'b'
+    assert bodies(database) == ['a', 'c']
+
+
+@pytest.mark.parametrize('group_commit', [False, True])
+def test_run_write_raises_in_caller_and_keeps_other_writes(database, monkeypatch, group_commit):
+    monkeypatch.setattr(library_db, 'GROUP_COMMIT', group_commit)
+    try:
+        assert library_db.run_write(database, insert('kept')) == 'kept'
+        with pytest.raises(ValueError, match='dropped'):
+            library_db.run_write(database, insert('dropped', fail=True))
+    finally:
+        writer = library_db._writers.pop(database, None)
+        if writer:
+            writer.close()
+    assert bodies(database) == ['kept']
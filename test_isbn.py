@@ -0,0 +1,30 @@
+import pytest
+
+from library_db import isbn_key
+
+
+@pytest.mark.parametrize('isbn', ['9780441172719', '0441172717', '978-0-441-17271-9', '0-441-17271-7', '0 441 17271 7'])
+def test_both_spellings_share_one_key(isbn):
+    assert isbn_key(isbn) == 9780441172719
+
+
+@pytest.mark.parametrize('isbn', ['080442957X', '080442957x', '0-8044-2957-X'])
+def test_isbn10_with_x_check_digit(isbn):
+    # 978 + 080442957 needs a fresh ISBN-13 check digit, here 3
+    assert isbn_key(isbn) == 9780804429573
+
+
+@pytest.mark.parametrize('isbn', ['0441172718', '9780441172710', '0804429579', '978044117271X'])
+def test_bad_check_digit(isbn):
+    assert isbn_key(isbn) is None
+
+
+@pytest.mark.parametrize('isbn', [None, '', '12345', '04411727170', 'abcdefghij', '978-0-441-17271'])
+def test_not_an_isbn(isbn):
+    assert isbn_key(isbn) is None
+
+
+def test_design_patterns_check_digit():
+    # Design Patterns once shipped with a typo in its check digit
+    assert isbn_key('9780201633610') == 9780201633610
+    assert isbn_key('9780201633612') is None
@@ -0,0 +1,34 @@
+import importlib
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def apps(tmp_path, monkeypatch):
+    # Both apps create and seed their databases in the working directory on import
+    monkeypatch.chdir(tmp_path)
+    for name in ('app', 'app_enhanced'):
+        sys.modules.pop(name, None)
+    enhanced = importlib.import_module('app_enhanced')
+    simple = importlib.import_module('app')
+    yield simple, enhanced
+    for name in ('app', 'app_enhanced'):
+        sys.modules.pop(name, None)
+
+
+def test_loans_issued_through_app_feed_recommendations(apps):
+    simple, enhanced = apps
+    client = simple.app.test_client()
+    loans = {'Ana Diaz': (1, 2, 3), 'ana  diaz': (4,), 'Ben Okafor': (1, 2)}
+    for borrower, book_ids in loans.items():
+        for book_id in book_ids:
+            client.post(f'/issue/{book_id}', data={'borrower': borrower, 'days': '14'})
+            client.get(f'/return/{book_id}')
+
+    conn = enhanced.get_db_connection()
+    assert enhanced.update_recommendations(conn) == (6, 4)
+    conn.close()
+
+    response = enhanced.app.test_client().get('/api/recommendations/1')
+    assert [(book['id'], book['score']) for book in response.get_json()] == [(2, 2), (3, 1), (4, 1)]